@@ -1,10 +1,19 @@
 import streamlit as st
 import os
 from google import genai
-from google.genai import types
+from google.genai import types, errors
+import httpx
 import json
 import pandas as pd
 import io
+from PIL import Image, ImageOps
+import asyncio
+import hashlib
+import time
+import tempfile
+from pathlib import Path
+from typing import Optional
+from pydantic import BaseModel, Field
 
 # --- 1. CONFIGURATION AND INITIALIZATION ---
 
@@ -14,63 +23,165 @@ st.title("💰 GenAI Bill Analytics Assistant")
 st.markdown("Upload a bill image to extract structured data and query the information.")
 
 # Initialize the Gemini Client using the secret key defined in .streamlit/secrets.toml
-try:
-    # Uses the key defined as GEMINI_API_KEY in the secrets.toml file
-    client = genai.Client(api_key=st.secrets["GEMINI_API_KEY"])
-except KeyError:
-    st.error("Error: 'GEMINI_API_KEY' not found in Streamlit secrets. "
-             "Please check your .streamlit/secrets.toml file.")
-    st.stop()
-except Exception as e:
-    st.error(f"Error initializing Gemini client: {e}")
-    st.stop()
+@st.cache_resource(show_spinner=False)
+def get_client():
+    """Creates the Gemini client once and reuses it across reruns."""
+    try:
+        # Uses the key defined as GEMINI_API_KEY in the secrets.toml file
+        return genai.Client(api_key=st.secrets["GEMINI_API_KEY"])
+    except KeyError:
+        st.error("Error: 'GEMINI_API_KEY' not found in Streamlit secrets. "
+                 "Please check your .streamlit/secrets.toml file.")
+        st.stop()
+    except Exception as e:
+        st.error(f"Error initializing Gemini client: {e}")
+        st.stop()
+
+client = get_client()
 
 # Define the structured output schema for the bill data (Requirement 2 & 5)
-BILL_SCHEMA = {
-    "type": "object",
-    "properties": {
-        "invoice_number": {"type": "string", "description": "The unique invoice or bill number."},
-        "invoice_date": {"type": "string", "description": "The date the bill was issued (e.g., DD/MM/YYYY)."},
-        "seller_name": {"type": "string", "description": "The name of the company or seller who issued the bill."},
-        "customer_name": {"type": "string", "description": "The name of the customer the bill is addressed to (Bill To)."},
-        "grand_total": {"type": "number", "description": "The final total amount paid."},
-        "currency": {"type": "string", "description": "The currency of the grand total (e.g., INR, USD)."},
-        "items": {
-            "type": "array",
-            "description": "A list of all individual products or services purchased.",
-            "items": {
-                "type": "object",
-                "properties": {
-                    "description": {"type": "string", "description": "Product or service description/title."},
-                    "quantity": {"type": "integer", "description": "Number of units purchased."},
-                    "unit_price": {"type": "number", "description": "Price per unit before any discount/tax."},
-                    "total_amount": {"type": "number", "description": "Final total amount for this item."}
-                },
-                "required": ["description", "quantity", "total_amount"]
-            }
-        }
-    },
-    "required": ["invoice_number", "invoice_date", "seller_name", "grand_total", "items"]
-}
+# Passed directly as response_schema, so Gemini returns an already-typed Bill
+class Item(BaseModel):
+    description: str = Field(description="Product or service description/title.")
+    quantity: int = Field(description="Number of units purchased.")
+    unit_price: Optional[float] = Field(default=None, description="Price per unit before any discount/tax.")
+    total_amount: float = Field(description="Final total amount for this item.")
+
+class Bill(BaseModel):
+    invoice_number: str = Field(description="The unique invoice or bill number.")
+    invoice_date: str = Field(description="The date the bill was issued (e.g., DD/MM/YYYY).")
+    seller_name: str = Field(description="The name of the company or seller who issued the bill.")
+    customer_name: Optional[str] = Field(default=None, description="The name of the customer the bill is addressed to (Bill To).")
+    grand_total: float = Field(description="The final total amount paid.")
+    currency: Optional[str] = Field(default=None, description="The currency of the grand total (e.g., INR, USD).")
+    items: list[Item] = Field(description="A list of all individual products or services purchased.")
+
+# On-disk cache of parsed bills, keyed by the SHA-256 of the image bytes
+BILL_CACHE_DIR = Path("data/bills")
+BILL_CACHE_TTL_SECONDS = 24 * 60 * 60
+
+# Uploaded images are downscaled to this longest side and re-encoded as JPEG before parsing
+MAX_IMAGE_SIDE = 1600
+JPEG_QUALITY = 85
+
+# Maximum number of bills sent to Gemini at the same time
+MAX_CONCURRENT_PARSES = 4
+# Delay before a bill that hit a transient error (e.g. a 429) is sent to Gemini again
+PARSE_RETRY_DELAY_SECONDS = 60
+
+WELCOME_MESSAGE = "Hello! Please upload a bill image to begin analysis."
+
+# Maximum number of chat messages kept in session state and re-rendered on each rerun
+MAX_MESSAGES = 20
+
+# Explicit context caching of the bill context; Gemini rejects caches below a minimum token count
+CONTEXT_CACHE_MIN_TOKENS = 1024
+CONTEXT_CACHE_TTL_SECONDS = 60 * 60
 
 # Initialize session state for persistent data (chat history and parsed bill)
-if "messages" not in st.session_state:
-    st.session_state["messages"] = [{"role": "assistant", "content": "Hello! Please upload a bill image to begin analysis."}]
-if "parsed_data" not in st.session_state:
-    st.session_state["parsed_data"] = None
+ss = st.session_state
+ss.setdefault("messages", [{"role": "assistant", "content": WELCOME_MESSAGE}])
+ss.setdefault("parsed_data", None)
+ss.setdefault("file_hash", None)
+ss.setdefault("file_hashes", {})
+ss.setdefault("bill_context", None)
+ss.setdefault("bills", {})
+ss.setdefault("parse_failures", {})
+ss.setdefault("image_bytes", None)
+ss.setdefault("export_json", None)
 
 
 # --- 2. CORE FUNCTIONS ---
 
-@st.cache_data(show_spinner=False)
-def parse_bill_with_gemini(uploaded_file, schema):
-    """Uses Gemini to perform structured data extraction from an image."""
+@st.cache_resource(ttl=15 * 60, show_spinner=False)
+def cleanup_bill_cache():
+    """Deletes cached bills older than BILL_CACHE_TTL_SECONDS (runs at most every 15 minutes)."""
+    cutoff = time.time() - BILL_CACHE_TTL_SECONDS
+    for path in BILL_CACHE_DIR.glob("*.json"):
+        try:
+            if path.stat().st_mtime < cutoff:
+                path.unlink()
+        except OSError:
+            pass
+
+def load_cached_bill(key):
+    """Returns the cached parse for this image hash, or None if it is not on disk."""
+    path = BILL_CACHE_DIR / f"{key}.json"
+    try:
+        return Bill.model_validate_json(path.read_text()).model_dump()
+    except (OSError, ValueError):
+        return None
+
+def save_cached_bill(key, parsed):
+    """Writes the parsed bill to disk atomically so readers never see a partial file."""
+    tmp_path = None
+    try:
+        BILL_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        # A unique temp file per writer, so concurrent sessions saving the same bill don't clobber each other
+        with tempfile.NamedTemporaryFile("w", dir=BILL_CACHE_DIR, delete=False, suffix=".tmp") as tmp:
+            tmp_path = tmp.name
+            tmp.write(json.dumps(parsed))
+        os.replace(tmp_path, BILL_CACHE_DIR / f"{key}.json")
+    except OSError:
+        if tmp_path:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+
+def downscale_image(image_bytes, mime_type):
+    """Shrinks photos larger than MAX_IMAGE_SIDE and re-encodes them as JPEG to cut upload size and image tokens.
+
+    Images already within MAX_IMAGE_SIDE are sent unchanged, as are images whose re-encoded bytes would not
+    be smaller. Falls back to the original bytes if the image cannot be decoded.
+    """
+    try:
+        img = Image.open(io.BytesIO(image_bytes))
+        if max(img.size) <= MAX_IMAGE_SIDE:
+            return image_bytes, mime_type
+
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail((MAX_IMAGE_SIDE, MAX_IMAGE_SIDE), Image.LANCZOS)
+        if img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info):
+            # JPEG has no alpha; flatten onto white so transparent areas don't turn black
+            img = img.convert("RGBA")
+            background = Image.new("RGB", img.size, "white")
+            background.paste(img, mask=img.getchannel("A"))
+            img = background
+
+        buf = io.BytesIO()
+        img.convert("RGB").save(buf, "JPEG", quality=JPEG_QUALITY, optimize=True)
+        if buf.tell() >= len(image_bytes):
+            return image_bytes, mime_type
+        return buf.getvalue(), "image/jpeg"
+    except Exception:
+        return image_bytes, mime_type
+
+def is_transient_error(e):
+    """True for errors worth retrying later: rate limits, server errors and network failures."""
+    if isinstance(e, errors.APIError):
+        return e.code == 429 or (e.code or 0) >= 500
+    return isinstance(e, (httpx.TransportError, asyncio.TimeoutError))
+
+async def parse_bill_with_gemini(aclient, key, image_bytes, mime_type):
+    """Uses Gemini to perform structured data extraction from an image.
+
+    `key` is the SHA-256 of the image bytes, used for the on-disk cache. Transient errors
+    (see is_transient_error) are raised so the caller can retry; other failures return None.
+    """
+    # Re-uploads of the same bill are served from disk without calling Gemini
+    cached = load_cached_bill(key)
+    if cached is not None:
+        return cached
+
     try:
-        # Read the file content and convert to a Part object for Gemini
-        image_bytes = uploaded_file.read()
+        # Decode/resize off the event loop so concurrent parses are not serialized on it
+        image_bytes, mime_type = await asyncio.to_thread(downscale_image, image_bytes, mime_type)
+
+        # Convert the file content to a Part object for Gemini
         image = types.Part.from_bytes(
             data=image_bytes,
-            mime_type=uploaded_file.type
+            mime_type=mime_type
         )
         
         prompt = (
@@ -78,22 +189,62 @@ def parse_bill_with_gemini(uploaded_file, schema):
             "all the required information. Strictly adhere to the provided JSON schema."
         )
 
-        response = client.models.generate_content(
+        response = await aclient.models.generate_content(
             model='gemini-2.5-flash',
             contents=[prompt, image],
             config=types.GenerateContentConfig(
                 response_mime_type="application/json",
-                response_schema=schema,
+                response_schema=Bill,
             )
         )
-        return json.loads(response.text)
+        if response.parsed is None:
+            raise ValueError("Gemini did not return data matching the bill schema.")
+        parsed = response.parsed.model_dump()
+        save_cached_bill(key, parsed)
+        return parsed
     except Exception as e:
+        if is_transient_error(e):
+            raise
         st.error(f"Error during bill parsing: {e}")
         return None
 
-def chit_chat_and_query(extracted_data, user_query):
-    """Handles conversational interactions and bill-specific queries (Requirement 1 & 4)."""
-    
+async def parse_bills_with_gemini(files):
+    """Parses several (key, image_bytes, mime_type) tuples concurrently, returning results in the same order.
+
+    Transient errors are returned in place of the result instead of being raised.
+    """
+    # A fresh async client per event loop: asyncio.run() closes its loop, and pooled
+    # connections from a closed loop cannot be reused by the next run
+    async with genai.Client(api_key=st.secrets["GEMINI_API_KEY"]).aio as aclient:
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_PARSES)
+
+        async def parse_one(key, image_bytes, mime_type):
+            async with semaphore:
+                return await parse_bill_with_gemini(aclient, key, image_bytes, mime_type)
+
+        return await asyncio.gather(
+            *(parse_one(key, image_bytes, mime_type) for key, image_bytes, mime_type in files),
+            return_exceptions=True,
+        )
+
+def build_items_dataframe(items):
+    """Builds the line-items table from the validated bill items."""
+    # Items are already validated by the Bill model, so the numeric columns need no coercion
+    df = pd.DataFrame.from_records(items, columns=['description', 'quantity', 'unit_price', 'total_amount'])
+    return df.round({'unit_price': 2, 'total_amount': 2})
+
+def add_message(role, content):
+    """Appends a chat message to the displayed transcript, keeping only the last MAX_MESSAGES entries."""
+    ss["messages"].append({"role": role, "content": content})
+    ss["messages"] = ss["messages"][-MAX_MESSAGES:]
+
+def create_bill_context(extracted_data):
+    """Builds the grounding context for chat queries about the extracted bill data.
+
+    When the system instruction is large enough for Gemini's explicit context caching, it is uploaded
+    once into a server-side cache and later turns only reference it. Otherwise each query sends it as a
+    plain system instruction.
+    """
     # Context for the model
     bill_context = json.dumps(extracted_data, indent=2)
     
@@ -105,42 +256,145 @@ def chit_chat_and_query(extracted_data, user_query):
         f"\n\n--- BILL DATA START ---\n{bill_context}\n--- BILL DATA END---\n\n"
     )
 
-    try:
-        response = client.models.generate_content(
-            model='gemini-2.5-flash',
-            contents=[user_query],
-            config=types.GenerateContentConfig(
-                system_instruction=system_instruction
+    context = {"system_instruction": system_instruction, "cached_content": None}
+    # Rough token estimate (~4 chars per token) to skip a create call that would be rejected as too small
+    if len(system_instruction) // 4 >= CONTEXT_CACHE_MIN_TOKENS:
+        try:
+            cache = client.caches.create(
+                model='gemini-2.5-flash',
+                config=types.CreateCachedContentConfig(
+                    system_instruction=system_instruction,
+                    ttl=f"{CONTEXT_CACHE_TTL_SECONDS}s",
+                )
             )
-        )
-        return response.text
+            context["cached_content"] = cache.name
+        except Exception:
+            pass
+    return context
+
+def release_bill_context(context):
+    """Deletes the server-side cache behind a bill context, if it has one."""
+    if context and context["cached_content"]:
+        try:
+            client.caches.delete(name=context["cached_content"])
+        except Exception:
+            pass
+
+def stream_answer(context, user_query):
+    """Streams the answer text for one stateless query grounded on `context`."""
+    if context["cached_content"]:
+        config = types.GenerateContentConfig(cached_content=context["cached_content"])
+    else:
+        config = types.GenerateContentConfig(system_instruction=context["system_instruction"])
+
+    # Stream the answer so the first tokens render while the rest is generated
+    for chunk in client.models.generate_content_stream(
+        model='gemini-2.5-flash',
+        contents=[user_query],
+        config=config
+    ):
+        if chunk.text:
+            yield chunk.text
+
+def chit_chat_and_query(context, user_query):
+    """Handles conversational interactions and bill-specific queries (Requirement 1 & 4)."""
+    started = False
+    try:
+        try:
+            for text in stream_answer(context, user_query):
+                started = True
+                yield text
+        except errors.ClientError:
+            if started or not context["cached_content"]:
+                raise
+            # The context cache may have expired; resend the bill as a plain system instruction
+            context["cached_content"] = None
+            yield from stream_answer(context, user_query)
     except Exception as e:
-        return f"An error occurred while generating the response: {e}"
+        yield f"An error occurred while generating the response: {e}"
 
 
 # --- 3. STREAMLIT UI LAYOUT AND LOGIC ---
 
 # --- Sidebar: File Upload Section ---
-uploaded_file = st.sidebar.file_uploader("Upload Bill Image", type=["jpg", "jpeg", "png"])
+cleanup_bill_cache()
+uploaded_files = st.sidebar.file_uploader("Upload Bill Images", type=["jpg", "jpeg", "png"], accept_multiple_files=True)
 
-if uploaded_file and (st.session_state["parsed_data"] is None or uploaded_file.file_id != st.session_state.get("file_id")):
-    st.sidebar.info("Analyzing bill, please wait...")
-    
-    # Reset state for new file
-    st.session_state["parsed_data"] = None 
-    st.session_state["file_id"] = uploaded_file.file_id 
-    
-    # Call the parsing function
+# Hash each upload once; bills are keyed by content so re-selecting the same image never re-parses it
+ss["file_hashes"] = {
+    f.file_id: ss["file_hashes"].get(f.file_id) or hashlib.sha256(f.getvalue()).hexdigest() for f in uploaded_files
+}
+uploads = {ss["file_hashes"][f.file_id]: f for f in uploaded_files}
+
+# Forget bills whose files were removed from the uploader
+ss["bills"] = {digest: ss["bills"][digest] for digest in uploads if digest in ss["bills"]}
+ss["parse_failures"] = {digest: ss["parse_failures"][digest] for digest in uploads if digest in ss["parse_failures"]}
+
+# Files that hit a transient error wait PARSE_RETRY_DELAY_SECONDS before being sent to Gemini again
+now = time.time()
+new_hashes = []
+for digest in uploads:
+    if digest in ss["bills"]:
+        continue
+    retry_in = ss["parse_failures"].get(digest, 0) + PARSE_RETRY_DELAY_SECONDS - now
+    if retry_in > 0:
+        st.sidebar.warning(f"Could not analyze {uploads[digest].name} right now. Retrying in {int(retry_in) + 1}s.")
+    else:
+        new_hashes.append(digest)
+
+if new_hashes:
+    st.sidebar.info("Analyzing bill(s), please wait...")
+
+    # Parse all new files concurrently so the wait is the slowest bill, not the sum
     with st.spinner("Extracting structured data from image..."):
-        parsed_json = parse_bill_with_gemini(uploaded_file, BILL_SCHEMA)
-    
-    if parsed_json:
-        st.session_state["parsed_data"] = parsed_json
-        st.session_state["messages"].append({"role": "assistant", "content": f"✅ Bill from **{parsed_json.get('seller_name', 'Unknown Seller')}** successfully parsed! You can now query the data or export it."})
-        st.sidebar.success("Bill successfully analyzed!")
+        results = asyncio.run(parse_bills_with_gemini(
+            [(digest, uploads[digest].getvalue(), uploads[digest].type) for digest in new_hashes]
+        ))
+
+    for digest, parsed_json in zip(new_hashes, results):
+        if isinstance(parsed_json, Exception):
+            # Transient errors (e.g. rate limits) are not stored as results; the file is retried after a delay
+            ss["parse_failures"][digest] = time.time()
+            st.sidebar.warning(f"Could not analyze {uploads[digest].name} right now ({parsed_json}). Retrying in {PARSE_RETRY_DELAY_SECONDS}s.")
+            continue
+        ss["parse_failures"].pop(digest, None)
+        # Permanent failures are stored as None so they are not retried on every rerun
+        ss["bills"][digest] = parsed_json
+        if parsed_json:
+            st.sidebar.success(f"{uploads[digest].name} successfully analyzed!")
+        else:
+            st.sidebar.error(f"Failed to parse {uploads[digest].name}. Please try a different image.")
+
+# Pick the bill the main panel and chat work on
+parsed_hashes = [digest for digest, bill in ss["bills"].items() if bill]
+if len(parsed_hashes) > 1:
+    # A fixed key and explicit index keep the current bill selected when bills are added or removed
+    current_index = parsed_hashes.index(ss["file_hash"]) if ss["file_hash"] in parsed_hashes else 0
+    active_hash = st.sidebar.selectbox(
+        "Active Bill", parsed_hashes, index=current_index, key="active_bill",
+        format_func=lambda digest: uploads[digest].name
+    )
+else:
+    active_hash = parsed_hashes[0] if parsed_hashes else None
+
+if active_hash != ss["file_hash"]:
+    # Reset state when switching to another bill
+    ss["file_hash"] = active_hash
+    ss["parsed_data"] = ss["bills"].get(active_hash)
+    release_bill_context(ss["bill_context"])
+    ss["bill_context"] = create_bill_context(ss["parsed_data"]) if ss["parsed_data"] else None
+    # Start a fresh transcript so answers about the previous bill aren't shown under this one
+    if ss["parsed_data"]:
+        ss["messages"] = [{"role": "assistant", "content": f"✅ Bill from **{ss['parsed_data'].get('seller_name', 'Unknown Seller')}** successfully parsed! You can now query the data or export it."}]
     else:
-        st.sidebar.error("Failed to parse bill. Please try a different image.")
-        st.session_state["file_id"] = None
+        ss["messages"] = [{"role": "assistant", "content": WELCOME_MESSAGE}]
+    # Serialize the export once per bill instead of on every rerun
+    ss["export_json"] = json.dumps(ss["parsed_data"], indent=2)
+    # Keep the image bytes (read without consuming the upload stream) for the preview
+    ss["image_bytes"] = uploads[active_hash].getvalue() if active_hash else None
+
+if ss["image_bytes"]:
+    st.sidebar.image(ss["image_bytes"], caption=uploads[active_hash].name, width="stretch")
 
 # --- Main Content Area ---
 col1, col2 = st.columns([1, 1])
@@ -148,8 +402,8 @@ col1, col2 = st.columns([1, 1])
 # Column 1: Display Extracted Data & Export (Requirement 3)
 with col1:
     st.header("Extracted Structured Data")
-    if st.session_state["parsed_data"]:
-        data = st.session_state["parsed_data"]
+    if ss["parsed_data"]:
+        data = ss["parsed_data"]
         
         # Display key fields
         st.subheader("Key Information")
@@ -158,20 +412,14 @@ with col1:
         # Display Items in a table
         if data.get('items'):
             st.subheader("Line Items")
-            df = pd.DataFrame(data['items'])
-            # Format numbers
-            for col in ['unit_price', 'total_amount']:
-                 if col in df.columns:
-                     df[col] = pd.to_numeric(df[col], errors='coerce').round(2)
-            
+            df = build_items_dataframe(data['items'])
             st.dataframe(df, use_container_width=True)
         
         # Data Export
         st.subheader("Data Export")
-        json_string = json.dumps(data, indent=2)
         st.download_button(
             label="Download Data as JSON",
-            data=json_string,
+            data=ss["export_json"],
             file_name=f"{data.get('invoice_number', 'extracted')}_bill_data.json",
             mime="application/json",
             help="Click to save the extracted structured data."
@@ -183,27 +431,29 @@ with col1:
 with col2:
     st.header("Ask Questions about the Bill")
     
-    # Display previous messages
-    for message in st.session_state["messages"]:
-        with st.chat_message(message["role"]):
-            st.markdown(message["content"])
+    # The full (MAX_MESSAGES-capped) transcript is re-rendered every run; this container only
+    # makes the current turn appear after the transcript rather than after the inline chat input
+    chat_box = st.container()
+    with chat_box:
+        for message in ss["messages"]:
+            with st.chat_message(message["role"]):
+                st.markdown(message["content"])
 
     # Chat input
     if prompt := st.chat_input("Ask a question (e.g., 'What is the grand total?', 'What did I buy?', 'Say hello'):"):
         
         # Add user message to history
-        st.session_state["messages"].append({"role": "user", "content": prompt})
-        with st.chat_message("user"):
+        add_message("user", prompt)
+        with chat_box, st.chat_message("user"):
             st.markdown(prompt)
 
-        # Get response
-        with st.spinner("Thinking..."):
-            if st.session_state["parsed_data"]:
-                response = chit_chat_and_query(st.session_state["parsed_data"], prompt)
-            else:
-                # Basic chit-chat if no bill is uploaded
-                response = chit_chat_and_query({}, prompt)
-                
+        # Get response, rendering it incrementally as it streams in
+        if ss["bill_context"] is None:
+            # Basic chit-chat if no bill is uploaded
+            ss["bill_context"] = create_bill_context(ss["parsed_data"] or {})
+
+        with chat_box, st.chat_message("assistant"):
+            response = st.write_stream(chit_chat_and_query(ss["bill_context"], prompt))
+
         # Add assistant response to history
-        st.session_state["messages"].append({"role": "assistant", "content": response})
-        st.rerun() # Refresh the chat window
\ No newline at end of file
+        add_message("assistant", response)